@@ -0,0 +1,44 @@
+from django.utils.translation import gettext_lazy as _
+
+from rest_framework_simplejwt.authentication import JWTAuthentication
+from rest_framework_simplejwt.exceptions import AuthenticationFailed, InvalidToken
+from rest_framework_simplejwt.settings import api_settings
+from rest_framework_simplejwt.utils import get_md5_hash_password
+
+
+class BalanceJWTAuthentication(JWTAuthentication):
+    """
+    JWT authentication that loads the user's balance together with the user,
+    so accessing request.user.balance does not issue a separate query.
+    """
+
+    def get_user(self, validated_token):
+        """
+        Return the user for the given validated token with the balance joined in.
+
+        Mirrors JWTAuthentication.get_user from djangorestframework-simplejwt 5.5.x
+        (see poetry.lock), changing only the user lookup. Re-check it against
+        upstream when upgrading simplejwt, so new user checks are not missed.
+        """
+        try:
+            user_id = validated_token[api_settings.USER_ID_CLAIM]
+        except KeyError as e:
+            raise InvalidToken(_("Token contained no recognizable user identification")) from e
+
+        try:
+            user = self.user_model.objects.select_related("balance").get(
+                **{api_settings.USER_ID_FIELD: user_id}
+            )
+        except self.user_model.DoesNotExist as e:
+            raise AuthenticationFailed(_("User not found"), code="user_not_found") from e
+
+        if api_settings.CHECK_USER_IS_ACTIVE and not user.is_active:
+            raise AuthenticationFailed(_("User is inactive"), code="user_inactive")
+
+        if api_settings.CHECK_REVOKE_TOKEN:
+            if validated_token.get(api_settings.REVOKE_TOKEN_CLAIM) != get_md5_hash_password(user.password):
+                raise AuthenticationFailed(
+                    _("The user's password has been changed."), code="password_changed"
+                )
+
+        return user
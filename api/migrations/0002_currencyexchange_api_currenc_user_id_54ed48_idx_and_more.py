@@ -0,0 +1,23 @@
+# Generated by Django 5.2.18 on 2026-10-15 21:41
+
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0001_initial'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='currencyexchange',
+            index=models.Index(fields=['user', '-created_at'], name='api_currenc_user_id_54ed48_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='currencyexchange',
+            index=models.Index(fields=['user', 'currency_code'], name='api_currenc_user_id_9e3c9d_idx'),
+        ),
+    ]
@@ -11,6 +11,12 @@ class CurrencyExchange(models.Model):
     rate = models.DecimalField(max_digits=10, decimal_places=4)
     created_at = models.DateTimeField(auto_now_add=True)
 
+    class Meta:
+        indexes = [
+            models.Index(fields=["user", "-created_at"]),
+            models.Index(fields=["user", "currency_code"]),
+        ]
+
     def __str__(self):
         return f"{self.currency_code} - {self.rate}"
 
@@ -0,0 +1,14 @@
+from rest_framework.pagination import CursorPagination
+
+
+class HistoryCursorPagination(CursorPagination):
+    """
+    Cursor pagination for the exchange history, newest records first.
+    Unlike limit/offset pagination it does not count all matching records
+    and seeks each page through the (user, -created_at) index.
+    """
+    page_size = 50
+    page_size_query_param = "page_size"
+    max_page_size = 100
+    ordering = "-created_at"
+    cursor_query_param = "cursor"
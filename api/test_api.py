@@ -1,9 +1,22 @@
 import pytest
+from datetime import datetime, timezone
 from django.urls import reverse
 from rest_framework import status
 from rest_framework.test import APIClient
 from django.contrib.auth.models import User
+from django.core.cache import cache
 from api.models import UserBalance, CurrencyExchange
+from api.serializers import CurrencyExchangeSerializer
+
+
+@pytest.fixture(autouse=True)
+def clear_cache():
+    """
+    Clear cached exchange rates so each test starts from a cold cache.
+    """
+    cache.clear()
+    yield
+    cache.clear()
 
 
 @pytest.fixture
@@ -45,11 +58,14 @@ def jwt_auth_client(api_client, create_user):
 @pytest.fixture
 def fake_exchange_response(monkeypatch):
     """
-    Monkeypatch the requests.get call in the api.views module to return
-    a fake response with conversion_rates.
+    Monkeypatch the shared HTTP session in the api.views module to return
+    a fake response with conversion_rates. The number of calls is recorded
+    in the `calls` attribute of the returned function.
     """
 
-    def fake_get(url):
+    def fake_get(url, timeout=None):
+        fake_get.calls += 1
+
         class FakeResponse:
             status_code = 200
 
@@ -59,7 +75,9 @@ def fake_exchange_response(monkeypatch):
 
         return FakeResponse()
 
-    monkeypatch.setattr("api.views.requests.get", fake_get)
+    fake_get.calls = 0
+    monkeypatch.setattr("api.views._session.get", fake_get)
+    return fake_get
 
 
 def test_registration(api_client, db):
@@ -97,6 +115,48 @@ def test_balance(jwt_auth_client, create_user):
     assert json_data["balance"] == 10
 
 
+def test_balance_not_found(jwt_auth_client, create_user):
+    """
+    Test that the balance endpoint returns 404 when the user has no balance record.
+    """
+    UserBalance.objects.filter(user=create_user).delete()
+    url = reverse("balance")
+    response = jwt_auth_client.get(url)
+    assert response.status_code == status.HTTP_404_NOT_FOUND
+    assert response.json() == {"error": "Balance not found."}
+
+
+def test_balance_query_count(jwt_auth_client, create_user, django_assert_num_queries):
+    """
+    Test that the balance is loaded together with the authenticated user.
+    """
+    url = reverse("balance")
+    with django_assert_num_queries(1):
+        response = jwt_auth_client.get(url)
+    assert response.status_code == status.HTTP_200_OK
+
+
+def test_balance_etag(jwt_auth_client, fake_exchange_response, create_user):
+    """
+    Test that the balance endpoint answers 304 for a matching ETag, including
+    weak and wildcard matches, and returns a new ETag once the balance changes.
+    """
+    url = reverse("balance")
+    response = jwt_auth_client.get(url)
+    etag = response["ETag"]
+
+    for if_none_match in [etag, f"W/{etag}", f'"other", {etag}', "*"]:
+        response = jwt_auth_client.get(url, HTTP_IF_NONE_MATCH=if_none_match)
+        assert response.status_code == status.HTTP_304_NOT_MODIFIED
+        assert response["ETag"] == etag
+
+    jwt_auth_client.post(reverse("currency_exchange"), {"currency_code": "USD"}, format="json")
+    response = jwt_auth_client.get(url, HTTP_IF_NONE_MATCH=etag)
+    assert response.status_code == status.HTTP_200_OK
+    assert response["ETag"] != etag
+    assert response.json()["balance"] == 9
+
+
 def test_currency_exchange(jwt_auth_client, fake_exchange_response, create_user):
     """
     Test the currency exchange endpoint with a mocked external API.
@@ -105,7 +165,7 @@ def test_currency_exchange(jwt_auth_client, fake_exchange_response, create_user)
     url = reverse("currency_exchange")
     data = {"currency_code": "USD"}
     response = jwt_auth_client.post(url, data, format="json")
-    assert response.status_code == status.HTTP_200_OK
+    assert response.status_code == status.HTTP_201_CREATED
 
     # Verify that the user's balance decreased by 1 coin (from 10 to 9)
     user = User.objects.get(username="jwtuser")
@@ -120,6 +180,75 @@ def test_currency_exchange(jwt_auth_client, fake_exchange_response, create_user)
     assert json_data["rate"] in ["40.0", "40.0000", 40.0]
 
 
+@pytest.mark.parametrize("currency_code", [840, ["USD"], "US", "US D", "USDT"])
+def test_currency_exchange_invalid_code(jwt_auth_client, fake_exchange_response, create_user, currency_code):
+    """
+    Test that a currency code which is not a 3-letter string is rejected
+    without contacting the external API or spending a coin.
+    """
+    url = reverse("currency_exchange")
+    response = jwt_auth_client.post(url, {"currency_code": currency_code}, format="json")
+    assert response.status_code == status.HTTP_400_BAD_REQUEST
+    assert "error" in response.json()
+
+    assert fake_exchange_response.calls == 0
+    assert UserBalance.objects.get(user=create_user).balance == 10
+
+
+def test_currency_exchange_rate_is_cached(jwt_auth_client, fake_exchange_response, create_user):
+    """
+    Test that repeated exchanges for the same currency, in any letter case,
+    reuse the cached rate instead of calling the external API again.
+    """
+    url = reverse("currency_exchange")
+    for currency_code in ["USD", "usd"]:
+        response = jwt_auth_client.post(url, {"currency_code": currency_code}, format="json")
+        assert response.status_code == status.HTTP_201_CREATED
+        assert response.json()["currency_code"] == "USD"
+
+    assert fake_exchange_response.calls == 1
+    assert CurrencyExchange.objects.filter(currency_code="USD").count() == 2
+
+    response = jwt_auth_client.get(f"{reverse('history')}?currency_code=usd")
+    assert response.status_code == status.HTTP_200_OK
+    assert len(response.json()["results"]) == 2
+
+
+def test_currency_exchange_insufficient_balance(jwt_auth_client, fake_exchange_response, create_user):
+    """
+    Test that an exchange is rejected once the balance is spent, without
+    contacting the external API, and that neither the balance nor the history changes.
+    """
+    UserBalance.objects.filter(user=create_user).update(balance=0)
+    url = reverse("currency_exchange")
+    response = jwt_auth_client.post(url, {"currency_code": "USD"}, format="json")
+    assert response.status_code == status.HTTP_403_FORBIDDEN
+    assert fake_exchange_response.calls == 0
+
+    assert UserBalance.objects.get(user=create_user).balance == 0
+    assert not CurrencyExchange.objects.filter(user=create_user).exists()
+
+
+def test_currency_exchange_concurrent_spend(jwt_auth_client, fake_exchange_response, monkeypatch, create_user):
+    """
+    Test that the last coin cannot be spent twice when another request spends it
+    between the balance check and the balance update.
+    """
+    UserBalance.objects.filter(user=create_user).update(balance=1)
+
+    def spend_concurrently(url, timeout=None):
+        UserBalance.objects.filter(user=create_user).update(balance=0)
+        return fake_exchange_response(url, timeout=timeout)
+
+    monkeypatch.setattr("api.views._session.get", spend_concurrently)
+    url = reverse("currency_exchange")
+    response = jwt_auth_client.post(url, {"currency_code": "USD"}, format="json")
+    assert response.status_code == status.HTTP_403_FORBIDDEN
+
+    assert UserBalance.objects.get(user=create_user).balance == 0
+    assert not CurrencyExchange.objects.filter(user=create_user).exists()
+
+
 def test_history(jwt_auth_client, create_user):
     """
     Test the history endpoint to retrieve exchange records for the authenticated user.
@@ -134,11 +263,111 @@ def test_history(jwt_auth_client, create_user):
     response = jwt_auth_client.get(url)
     assert response.status_code == status.HTTP_200_OK
     json_data = response.json()
-    assert len(json_data) >= 1
+    assert len(json_data["results"]) >= 1
 
     # Test filtering by currency_code query parameter
     url_with_params = f"{url}?currency_code=USD"
     response_param = jwt_auth_client.get(url_with_params)
     assert response_param.status_code == status.HTTP_200_OK
     filtered_data = response_param.json()
-    assert len(filtered_data) >= 1
+    assert len(filtered_data["results"]) >= 1
+
+
+def test_history_matches_serializer(jwt_auth_client, create_user):
+    """
+    Test that history records have the same representation as CurrencyExchangeSerializer.
+    """
+    user = User.objects.get(username="jwtuser")
+    exchange = CurrencyExchange.objects.create(user=user, currency_code="USD", rate="41.2345")
+    exchange.refresh_from_db()
+    url = reverse("history")
+
+    response = jwt_auth_client.get(url)
+    assert response.status_code == status.HTTP_200_OK
+    assert response.json()["results"] == [dict(CurrencyExchangeSerializer(exchange).data)]
+
+
+def test_history_query_count(jwt_auth_client, create_user, django_assert_num_queries):
+    """
+    Test that the history endpoint does not issue a query per exchange record.
+    One query authenticates the user and one fetches the page of history.
+    """
+    user = User.objects.get(username="jwtuser")
+    CurrencyExchange.objects.bulk_create(
+        [CurrencyExchange(user=user, currency_code="USD", rate=40.0) for _ in range(5)],
+        batch_size=500,
+    )
+    url = reverse("history")
+
+    with django_assert_num_queries(2):
+        response = jwt_auth_client.get(url)
+    assert response.status_code == status.HTTP_200_OK
+    assert len(response.json()["results"]) == 5
+
+
+def test_history_pagination(jwt_auth_client, create_user):
+    """
+    Test that the history endpoint returns a bounded page, newest records first.
+    """
+    user = User.objects.get(username="jwtuser")
+    for day, code in enumerate(["USD", "EUR", "GBP"], start=1):
+        exchange = CurrencyExchange.objects.create(user=user, currency_code=code, rate=40.0)
+        CurrencyExchange.objects.filter(pk=exchange.pk).update(
+            created_at=datetime(2025, 3, day, tzinfo=timezone.utc)
+        )
+    url = reverse("history")
+
+    response = jwt_auth_client.get(f"{url}?page_size=2")
+    assert response.status_code == status.HTTP_200_OK
+    json_data = response.json()
+    assert [item["currency_code"] for item in json_data["results"]] == ["GBP", "EUR"]
+    assert "count" not in json_data
+
+    response = jwt_auth_client.get(json_data["next"])
+    assert response.status_code == status.HTTP_200_OK
+    json_data = response.json()
+    assert [item["currency_code"] for item in json_data["results"]] == ["USD"]
+    assert json_data["next"] is None
+
+
+def test_history_date_filter(jwt_auth_client, create_user):
+    """
+    Test that start_date and end_date include whole days at both boundaries.
+    """
+    user = User.objects.get(username="jwtuser")
+    created = {
+        "USD": datetime(2025, 3, 9, 23, 59, 59, tzinfo=timezone.utc),
+        "EUR": datetime(2025, 3, 10, 0, 0, 0, tzinfo=timezone.utc),
+        "GBP": datetime(2025, 3, 11, 23, 59, 59, 999999, tzinfo=timezone.utc),
+        "PLN": datetime(2025, 3, 12, 0, 0, 0, tzinfo=timezone.utc),
+    }
+    for code, created_at in created.items():
+        exchange = CurrencyExchange.objects.create(user=user, currency_code=code, rate=40.0)
+        CurrencyExchange.objects.filter(pk=exchange.pk).update(created_at=created_at)
+    url = reverse("history")
+
+    response = jwt_auth_client.get(f"{url}?start_date=2025-03-10&end_date=2025-03-11")
+    assert response.status_code == status.HTTP_200_OK
+    assert [item["currency_code"] for item in response.json()["results"]] == ["GBP", "EUR"]
+
+    response = jwt_auth_client.get(f"{url}?start_date=2025-03-12")
+    assert [item["currency_code"] for item in response.json()["results"]] == ["PLN"]
+
+    response = jwt_auth_client.get(f"{url}?end_date=2025-03-09")
+    assert [item["currency_code"] for item in response.json()["results"]] == ["USD"]
+
+    response = jwt_auth_client.get(f"{url}?start_date=2025-03-11&end_date=2025-03-10")
+    assert response.json()["results"] == []
+
+
+def test_history_date_filter_max_end_date(jwt_auth_client, create_user):
+    """
+    Test that the largest valid end_date includes every record instead of failing.
+    """
+    user = User.objects.get(username="jwtuser")
+    CurrencyExchange.objects.create(user=user, currency_code="USD", rate=40.0)
+    url = reverse("history")
+
+    response = jwt_auth_client.get(f"{url}?end_date=9999-12-31")
+    assert response.status_code == status.HTTP_200_OK
+    assert [item["currency_code"] for item in response.json()["results"]] == ["USD"]
@@ -1,7 +1,18 @@
-import os
+import functools
+import re
 import requests
-
+from datetime import date, datetime, time, timedelta
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import transaction
+from django.db.models import F
+from django.utils import timezone
+from django.utils.cache import get_conditional_response, patch_vary_headers
 from django.utils.dateparse import parse_date
+from django.utils.http import quote_etag
 
 from rest_framework import status, generics, permissions
 from rest_framework.response import Response
@@ -11,12 +22,68 @@ from drf_yasg import openapi
 from drf_yasg.utils import swagger_auto_schema
 
 from .models import CurrencyExchange, UserBalance
+from .pagination import HistoryCursorPagination
 from .serializers import (
     UserRegistrationSerializer,
     UserBalanceSerializer,
     CurrencyExchangeSerializer,
 )
 
+# Shared HTTP session so connections to the exchange rate API are kept alive
+# and reused between requests instead of opening a new TCP/TLS connection each time
+_session = requests.Session()
+_session.mount(
+    "https://",
+    HTTPAdapter(
+        pool_maxsize=32,
+        max_retries=Retry(total=2, backoff_factor=0.2, status_forcelist=[502, 503, 504]),
+    ),
+)
+
+# Exchange rate API settings do not change after startup, so read them once
+EXCHANGE_RATE_API_URL = settings.EXCHANGE_RATE_API_URL
+EXCHANGE_RATE_API_KEY = settings.EXCHANGE_RATE_API_KEY
+
+# URL format for ExchangeRate-API v6:
+# https://v6.exchangerate-api.com/v6/<API_KEY>/latest/<CURRENCY_CODE>
+_URL_PREFIX = f"{EXCHANGE_RATE_API_URL}/{EXCHANGE_RATE_API_KEY}/latest/"
+
+# ISO 4217 currency codes, e.g. "USD"
+CURRENCY_CODE_RE = re.compile(r"[A-Z]{3}")
+
+# Exchange rates are shared by all users, so they are cached for a short time.
+# Bump the version whenever the format of the cached value changes.
+RATE_CACHE_TIMEOUT = 60
+RATE_CACHE_VERSION = 1
+
+
+class ExchangeRateError(Exception):
+    """
+    Raised when the exchange rate API returns an unusable response.
+    """
+
+
+@functools.lru_cache(maxsize=256)
+def _url_for(currency_code):
+    """
+    Return the exchange rate API URL for the given currency code.
+    """
+    return _URL_PREFIX + currency_code
+
+
+def _fetch_rate(currency_code):
+    """
+    Fetch the UAH exchange rate for the given currency code from the exchange rate API.
+    """
+    response = _session.get(_url_for(currency_code), timeout=5)
+    if response.status_code != 200:
+        raise ExchangeRateError("Failed to retrieve exchange rate.")
+    data = response.json()
+    # Retrieve the exchange rate for UAH from the conversion_rates field
+    rate = data.get("conversion_rates", {}).get("UAH")
+    if rate is None:
+        raise ExchangeRateError("Exchange rate for UAH not found.")
+    return rate
 
 
 class RegistrationAPIView(APIView):
@@ -59,34 +126,60 @@ class RegistrationAPIView(APIView):
         )
 
 
-class BalanceAPIView(APIView):
+class BalanceAPIView(generics.RetrieveAPIView):
     """
     API view to retrieve the current balance of the authenticated user.
+    Responses carry an ETag so polling clients can revalidate with If-None-Match.
     """
     permission_classes = [permissions.IsAuthenticated]
+    serializer_class = UserBalanceSerializer
 
     @swagger_auto_schema(
         operation_summary="Retrieve user balance",
-        operation_description="Return the current coin balance for the authenticated user.",
+        operation_description=(
+            "Return the current coin balance for the authenticated user. "
+            "Send the received ETag in 'If-None-Match' to get 304 while the balance is unchanged."
+        ),
         responses={
             200: openapi.Response("Current balance", UserBalanceSerializer),
+            304: "Not Modified",
             404: "Balance not found"
         }
     )
-    def get(self, request):
+    def get(self, request, *args, **kwargs):
         """
         Handle GET requests to retrieve the user's balance.
         """
+        return super().get(request, *args, **kwargs)
+
+    def get_object(self):
+        """
+        Return the balance of the authenticated user, which is loaded
+        together with the user during authentication.
+        """
+        return self.request.user.balance
+
+    def retrieve(self, request, *args, **kwargs):
+        """
+        Return the balance, or 304 if it matches the ETag sent in If-None-Match.
+        """
         try:
-            balance_obj = request.user.balance
-            serializer = UserBalanceSerializer(balance_obj)
-            return Response(serializer.data, status=status.HTTP_200_OK)
+            balance_obj = self.get_object()
         except UserBalance.DoesNotExist:
             return Response(
                 {"error": "Balance not found."},
                 status=status.HTTP_404_NOT_FOUND
             )
 
+        etag = quote_etag(f"{balance_obj.user_id}-{balance_obj.balance}")
+        response = get_conditional_response(request, etag=etag)
+        if response is None:
+            serializer = self.get_serializer(balance_obj)
+            response = Response(serializer.data, status=status.HTTP_200_OK)
+        response["ETag"] = etag
+        patch_vary_headers(response, ["Authorization"])
+        return response
+
 
 class CurrencyExchangeAPIView(APIView):
     """
@@ -132,44 +225,48 @@ class CurrencyExchangeAPIView(APIView):
         currency_code = request.data.get("currency_code")
         if not currency_code:
             return Response({"error": "Currency code is required."}, status=status.HTTP_400_BAD_REQUEST)
+        if not isinstance(currency_code, str):
+            return Response({"error": "Currency code must be a 3-letter code, e.g. 'USD'."}, status=status.HTTP_400_BAD_REQUEST)
+        # Normalize the code once, so it is safe to use in the cache key and the URL
+        currency_code = currency_code.upper()
+        if not CURRENCY_CODE_RE.fullmatch(currency_code):
+            return Response({"error": "Currency code must be a 3-letter code, e.g. 'USD'."}, status=status.HTTP_400_BAD_REQUEST)
 
         # Check if the user has enough balance (decrement by 1 coin per request)
         balance_obj = request.user.balance
         if balance_obj.balance <= 0:
             return Response({"error": "Insufficient balance."}, status=status.HTTP_403_FORBIDDEN)
 
-        # Retrieve the exchange API URL and key from environment variables
-        exchange_api_url = os.getenv("EXCHANGE_RATE_API_URL", "https://api.exchangerate-api.com/v4/latest")
-        exchange_api_key = os.getenv("EXCHANGE_RATE_API_KEY", "")
-        if not exchange_api_key:
+        if not EXCHANGE_RATE_API_KEY:
             return Response({"error": "Exchange rate API key is not configured."}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
 
-        # Construct the API URL for ExchangeRate-API v6:
-        # URL format: https://v6.exchangerate-api.com/v6/<API_KEY>/latest/<CURRENCY_CODE>
-        api_url = f"{exchange_api_url}/{exchange_api_key}/latest/{currency_code}"
         try:
-            response = requests.get(api_url, timeout=5)
-            if response.status_code != 200:
-                return Response({"error": "Failed to retrieve exchange rate."}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
-            data = response.json()
-            # Retrieve the exchange rate for UAH from the conversion_rates field
-            rate = data.get("conversion_rates", {}).get("UAH")
-            if rate is None:
-                return Response({"error": "Exchange rate for UAH not found."}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
+            rate = cache.get_or_set(
+                f"fx:{currency_code}",
+                lambda: _fetch_rate(currency_code),
+                RATE_CACHE_TIMEOUT,
+                version=RATE_CACHE_VERSION,
+            )
+        except ExchangeRateError as e:
+            return Response({"error": str(e)}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
         except requests.RequestException as e:
             return Response({"error": f"Error contacting exchange rate API: {str(e)}"}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
 
-        # Decrement the balance and save
-        balance_obj.balance -= 1
-        balance_obj.save()
-
-        # Create a new CurrencyExchange record
-        exchange_record = CurrencyExchange(
-            user=request.user,
-            currency_code=currency_code,
-            rate=rate
-        )
-        exchange_record.save()
+        with transaction.atomic():
+            # Decrement the balance in a single conditional UPDATE, so concurrent
+            # requests cannot spend the same coin twice
+            updated = UserBalance.objects.filter(
+                user=request.user, balance__gt=0
+            ).update(balance=F("balance") - 1)
+            if not updated:
+                return Response({"error": "Insufficient balance."}, status=status.HTTP_403_FORBIDDEN)
+
+            # Create a new CurrencyExchange record
+            exchange_record = CurrencyExchange.objects.create(
+                user=request.user,
+                currency_code=currency_code,
+                rate=rate
+            )
 
         serializer = CurrencyExchangeSerializer(exchange_record)
         return Response(serializer.data, status=status.HTTP_201_CREATED)
@@ -179,15 +276,18 @@ class HistoryView(generics.ListAPIView):
     """
     API view to retrieve the history of currency exchange requests for the authenticated user.
     Supports optional filtering by currency code and date.
+    Results are paginated and ordered from newest to oldest.
     """
     permission_classes = [permissions.IsAuthenticated]
     serializer_class = CurrencyExchangeSerializer
+    pagination_class = HistoryCursorPagination
 
     @swagger_auto_schema(
         operation_summary="Get exchange history",
         operation_description=(
-            "Return a list of previous currency exchange requests for the authenticated user. "
-            "Optional query parameters: 'currency_code' (e.g. 'USD') and 'date' (YYYY-MM-DD)."
+            "Return a paginated list of previous currency exchange requests for the authenticated user, "
+            "newest first. Optional query parameters: 'currency_code' (e.g. 'USD'), "
+            "'start_date' and 'end_date' (YYYY-MM-DD), 'page_size' and 'cursor'."
         ),
         manual_parameters=[
             openapi.Parameter(
@@ -216,19 +316,46 @@ class HistoryView(generics.ListAPIView):
         """
         return super().get(request, *args, **kwargs)
 
+    def list(self, request, *args, **kwargs):
+        """
+        Return the page of history records built from plain rows.
+        Each value goes through its serializer field, so the output matches
+        CurrencyExchangeSerializer without instantiating a model and a
+        serializer per row.
+        """
+        fields = self.get_serializer().fields
+        names = list(fields)
+
+        queryset = self.filter_queryset(self.get_queryset()).values(*names)
+        page = self.paginate_queryset(queryset)
+        rows = page if page is not None else queryset
+
+        data = [
+            {name: fields[name].to_representation(row[name]) for name in names}
+            for row in rows
+        ]
+        if page is not None:
+            return self.get_paginated_response(data)
+        return Response(data)
+
     def get_queryset(self):
         """
         Return the queryset of CurrencyExchange records filtered by the authenticated user
         and optionally by currency_code and date provided as query parameters.
         """
-        queryset = CurrencyExchange.objects.filter(user=self.request.user)
+        queryset = (
+            CurrencyExchange.objects
+            .filter(user=self.request.user)
+            .order_by("-created_at")
+        )
 
         currency_code = self.request.query_params.get("currency_code")
         start_date = self.request.query_params.get("start_date")
         end_date = self.request.query_params.get("end_date")
 
         if currency_code:
-            queryset = queryset.filter(currency_code=currency_code)
+            # Currency codes are stored in upper case
+            queryset = queryset.filter(currency_code=currency_code.upper())
 
         start_date = parse_date(start_date) if start_date else None
         end_date = parse_date(end_date) if end_date else None
@@ -236,11 +363,14 @@ class HistoryView(generics.ListAPIView):
         if (start_date and end_date) and start_date > end_date:
             return queryset.none()
 
-        if start_date and end_date:
-            queryset = queryset.filter(created_at__date__range=[start_date, end_date])
-        elif start_date:
-            queryset = queryset.filter(created_at__date__gte=start_date)
-        elif end_date:
-            queryset = queryset.filter(created_at__date__lte=end_date)
+        # Compare against datetime bounds instead of casting created_at to a date,
+        # so the (user, -created_at) index can be used for a range scan
+        if start_date:
+            start_dt = timezone.make_aware(datetime.combine(start_date, time.min))
+            queryset = queryset.filter(created_at__gte=start_dt)
+        # date.max has no next day, and every record is on or before it anyway
+        if end_date and end_date != date.max:
+            end_dt = timezone.make_aware(datetime.combine(end_date + timedelta(days=1), time.min))
+            queryset = queryset.filter(created_at__lt=end_dt)
 
         return queryset